@@ -1,20 +1,50 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import io
 import re
-import xml.etree.ElementTree as ET
+from collections import Counter
+from copy import copy
 from datetime import datetime
-from typing import Any
+from functools import lru_cache
+from typing import Any, Container, Iterable, Iterator
 
 import pandas as pd
 import numpy as np
 from fastapi import FastAPI, File, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from openpyxl import Workbook
-from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
 
+try:
+    from lxml import etree as ET
+
+    _ITERPARSE_OPTIONS: dict[str, Any] = {"resolve_entities": False, "no_network": True}
+except ImportError:  # lxml is optional; the stdlib parser gives the same results, only slower
+    import xml.etree.ElementTree as ET
+
+    _ITERPARSE_OPTIONS = {}
+
+try:
+    import python_calamine  # noqa: F401
+
+    _EXCEL_ENGINE: str | None = "calamine"
+except ImportError:  # python-calamine is optional; pandas falls back to openpyxl
+    _EXCEL_ENGINE = None
+
+_WS_RE = re.compile(r"\s+")
+_LINE_BREAK_RE = re.compile(r"[\n\r\v\f\x1c-\x1e\x85\u2028\u2029]")
+_LETTER_RE = re.compile(r"[^\W\d_]")
+_UPPER_RE = re.compile(r"[A-ZÀ-ÖØ-Þ]")
+_TEXT_COLUMNS = ("postnr", "kapittel", "kapittel_navn", "ns_code", "specification", "enhet", "beskrivelse", "ns_title")
+_CATEGORY_COLUMNS = ("postnr", "kapittel", "ns_code")
+# Norwegian number formatting: drop (non-breaking) thousand separators, decimal comma to point.
+_NUM_TRANS = str.maketrans({" ": None, "\u00a0": None, ",": "."})
+
 app = FastAPI(title="Bid Compare Tool", version="1.0.0")
 
 # CORS configuration
@@ -27,6 +57,12 @@ app.add_middleware(
 )
 
 
+def _clean_numeric(series: pd.Series) -> pd.Series:
+    """Convert Norwegian formatted numbers ("1 234,50") to floats in a single string pass."""
+    cleaned = series.astype(str).str.translate(_NUM_TRANS)
+    return pd.to_numeric(cleaned, errors="coerce").fillna(0.0)
+
+
 def _normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
     cols = {c.lower(): c for c in df.columns}
 
@@ -66,58 +102,59 @@ def _normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
         df2["qty"] = pd.to_numeric(df2["qty"], errors="coerce").fillna(0.0)
 
     if "unit_price" in df2.columns:
-        df2["unit_price"] = (
-            df2["unit_price"]
-            .astype(str)
-            .str.replace(" ", "", regex=False)
-            .str.replace(",", ".", regex=False)
-        )
-        df2["unit_price"] = pd.to_numeric(df2["unit_price"], errors="coerce").fillna(0.0)
+        df2["unit_price"] = _clean_numeric(df2["unit_price"])
 
     if "sum_amount" in df2.columns:
-        df2["sum_amount"] = (
-            df2["sum_amount"]
-            .astype(str)
-            .str.replace(" ", "", regex=False)
-            .str.replace(",", ".", regex=False)
-        )
-        df2["sum_amount"] = pd.to_numeric(df2["sum_amount"], errors="coerce").fillna(0.0)
+        df2["sum_amount"] = _clean_numeric(df2["sum_amount"])
+    elif "unit_price" in df2.columns:
+        df2["sum_amount"] = df2["qty"] * df2["unit_price"]
     else:
-        df2["sum_amount"] = df2.get("qty", 0.0) * df2.get("unit_price", 0.0)
+        df2["sum_amount"] = 0.0
 
     if "ns_code" not in df2.columns:
         df2["ns_code"] = ""
     if "ns_title" not in df2.columns:
         df2["ns_title"] = ""
     if "specification" not in df2.columns:
-        df2["specification"] = df2.get("beskrivelse", "").astype(str)
+        df2["specification"] = df2["beskrivelse"]
     if "is_option" not in df2.columns:
         df2["is_option"] = False
+    df2["is_option"] = df2["is_option"].astype(bool)
     if "kapittel_navn" not in df2.columns:
         df2["kapittel_navn"] = ""
 
-    def chapter_of(value: Any) -> str:
-        text = str(value or "").strip()
-        return text[:2] if len(text) >= 2 else "00"
+    df2 = _clean_text_columns(df2)
+    postnr = df2["postnr"]
+    df2["kapittel"] = postnr.str.slice(0, 2).where(postnr.str.len() >= 2, "00")
+    return _categorize_keys(df2)
+
+
+def _clean_text_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Turn missing text into "" and strip it once, so later steps can use the cells as they are."""
+    for column in df.columns.intersection(_TEXT_COLUMNS, sort=False):
+        df[column] = df[column].fillna("").astype(str).str.strip()
+    return df
 
-    df2["kapittel"] = df2["postnr"].apply(chapter_of)
-    df2["ns_title"] = df2.get("ns_title", "").astype(str)
-    df2["specification"] = df2.get("specification", df2.get("beskrivelse", "")).astype(str)
-    df2["kapittel_navn"] = df2.get("kapittel_navn", "").astype(str)
-    return df2
+
+def _categorize_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """Store the repetitive key columns as categoricals so groupby and merge hash integer codes."""
+    for column in _CATEGORY_COLUMNS:
+        df[column] = df[column].astype("category")
+    return df
 
 
 def _read_tabular(name: str, data: bytes) -> pd.DataFrame:
     try:
         if name.lower().endswith(".xlsx") or name.lower().endswith(".xls"):
-            return pd.read_excel(io.BytesIO(data))
+            return pd.read_excel(io.BytesIO(data), sheet_name=0, engine=_EXCEL_ENGINE)
+        # Pick the delimiter from the header line so the file is parsed once; Norwegian
+        # exports use ";" because "," is the decimal separator.
+        header = data.split(b"\n", 1)[0]
+        sep = ";" if header.count(b";") >= header.count(b",") else ","
         try:
-            df = pd.read_csv(io.BytesIO(data), sep=";")
-            if df.shape[1] == 1:
-                df = pd.read_csv(io.BytesIO(data))
-        except Exception:
-            df = pd.read_csv(io.BytesIO(data), encoding="latin-1")
-        return df
+            return pd.read_csv(io.BytesIO(data), sep=sep)
+        except UnicodeDecodeError:
+            return pd.read_csv(io.BytesIO(data), sep=sep, encoding="latin-1")
     except Exception as exc:
         raise HTTPException(status_code=400, detail=f"Could not read {name}: {exc}") from exc
 
@@ -130,293 +167,425 @@ def _to_float(value: Any) -> float:
     text = str(value).strip()
     if not text:
         return 0.0
-    text = text.replace(" ", "").replace("\u00a0", "").replace(",", ".")
+    text = text.translate(_NUM_TRANS)
     try:
         return float(text)
     except ValueError:
         return 0.0
 
 
-def _parse_ns3459_xml(data: bytes, name: str) -> pd.DataFrame:
-    try:
-        root = ET.fromstring(data)
-    except ET.ParseError as exc:
-        raise HTTPException(status_code=400, detail=f"Could not read {name}: {exc}") from exc
+def _parse_xml_root(data: bytes) -> Any:
+    """Parse XML and strip namespaces from all tags so lookups can use bare names."""
+    events = ET.iterparse(io.BytesIO(data), events=("end",), **_ITERPARSE_OPTIONS)
+    for _, element in events:
+        element.tag = element.tag.rpartition("}")[2]
+    return events.root
+
+
+_XML_STREAM_THRESHOLD = 1024 * 1024
+_NS3459_COLUMNS = [
+    "postnr",
+    "beskrivelse",
+    "enhet",
+    "qty",
+    "unit_price",
+    "sum_amount",
+    "kapittel",
+    "kapittel_navn",
+    "ns_code",
+    "ns_title",
+    "specification",
+    "is_option",
+]
+# Columns the comparison, chapter and summary steps read from the non-option part of a bid.
+_BASE_BID_COLUMNS = [
+    "postnr",
+    "qty",
+    "unit_price",
+    "sum_amount",
+    "kapittel",
+    "kapittel_navn",
+    "ns_code",
+    "specification",
+    "enhet",
+]
+_COMPANY_NAME_PATHS = [
+    "Pristilbud/Generelt/Avsender/Firma/Navn",
+    "Prisforesporsel/Generelt/Avsender/Firma/Navn",
+    "ProsjektNS/Generelt/Avsender/Firma/Navn",
+]
+
+
+def _iter_xml(data: bytes) -> Iterator[tuple[Any, list[Any]]]:
+    """Yield each element with its open ancestors as it closes, with namespaces stripped from tags."""
+    ancestors: list[Any] = []
+    for event, element in ET.iterparse(io.BytesIO(data), events=("start", "end"), **_ITERPARSE_OPTIONS):
+        if event == "start":
+            element.tag = element.tag.rpartition("}")[2]
+            ancestors.append(element)
+        else:
+            ancestors.pop()
+            yield element, ancestors
 
-    if root.tag.startswith("{"):
-        ns_uri = root.tag.split("}")[0][1:]
-    else:
-        ns_uri = ""
 
-    def tag(label: str) -> str:
-        return f"{{{ns_uri}}}{label}" if ns_uri else label
+def _chapter_name_entry(element: Any) -> tuple[str, str] | None:
+    if (element.findtext("Type") or "").strip() != "Type1":
+        return None
+    kode = (element.findtext("Kode") or "").strip()
+    navn = (element.findtext("Navn") or "").strip()
+    if not kode or not navn:
+        return None
+    return kode, navn
 
-    chapter_names: dict[str, str] = {}
-    postnrplan = root.find(f"{tag('Pristilbud')}/{tag('ProsjektNS')}/{tag('Postnrplan')}")
-    if postnrplan is not None:
-        for element in postnrplan.findall(f".//{tag('PostnrdelKode')}"):
-            type_value = (element.findtext(tag("Type")) or "").strip()
-            if type_value != "Type1":
-                continue
-            kode = (element.findtext(tag("Kode")) or "").strip()
-            navn = (element.findtext(tag("Navn")) or "").strip()
-            if kode and navn and kode not in chapter_names:
-                chapter_names[kode] = navn
 
-    posts = root.findall(f".//{tag('Post')}")
-    if not posts:
-        raise HTTPException(status_code=400, detail=f"No posts found in {name}")
+def _post_record(post: Any) -> dict[str, Any]:
+    postnr = (post.findtext("Postnr") or "").strip()
+    tekst_main = post.findtext("Tekst/Uformatert") or ""
+    tekst_main = (
+        tekst_main.replace("\r\n", "\n").replace("\r", "\n").strip()
+    )
 
-    records: list[dict[str, Any]] = []
-    for post in posts:
-        postnr = (post.findtext(tag("Postnr")) or "").strip()
-        tekst_main = post.findtext(f"{tag('Tekst')}/{tag('Uformatert')}") or ""
-        tekst_main = (
-            tekst_main.replace("\r\n", "\n").replace("\r", "\n").strip()
-        )
+    prisinfo = post.find("Prisinfo")
+    enhet = ""
+    qty = 0.0
+    unit_price = 0.0
+    sum_amount = 0.0
+    if prisinfo is not None:
+        enhet = (prisinfo.findtext("Enhet") or "").strip()
+        qty = _to_float(prisinfo.findtext("Mengde"))
+        unit_price = _to_float(prisinfo.findtext("Enhetspris"))
+        sum_amount = _to_float(prisinfo.findtext("Sum"))
+    if sum_amount == 0.0:
+        sum_amount = qty * unit_price
+
+    kapittel = ""
+    for pn in post.findall("Postnrdeler/Postnrdel"):
+        if (pn.findtext("Type") or "").strip() == "Type1":
+            kapittel = (pn.findtext("Kode") or "").strip()
+            break
+    if not kapittel and postnr:
+        kapittel = postnr.split(".")[0]
+
+    def parse_option(value: Any) -> bool:
+        text = str(value or "").strip().lower()
+        if text in {"true", "1", "ja", "yes"}:
+            return True
+        return False
+
+    is_option = bool(prisinfo is not None and parse_option(prisinfo.get("Opsjon")))
+
+    kode = post.find("Kode")
+    ns_code = ""
+    ns_title = ""
+    if kode is not None:
+        ns_code = (kode.findtext("ID") or "").strip()
+        ns_title = (kode.findtext("Kodetekst/Overskrift") or "").strip()
+        kodetekst = kode.find("Kodetekst")
+    else:
+        kodetekst = None
+
+    spec_parts: list[str] = []
+    seen = set()
+
+    def add_part(val: str):
+        val = val.strip()
+        if not val:
+            return
+        key = val.lower()
+        if key in seen:
+            return
+        seen.add(key)
+        spec_parts.append(val)
+
+    add_part(ns_title)
+    add_part(tekst_main)
+
+    if kodetekst is not None:
+        for u in kodetekst.findall(".//Uformatert"):
+            add_part(u.text or "")
+        for txt in kodetekst.findall(".//Tekst"):
+            if txt.get("OriginalFormat", "") == "RTF":
+                continue
+            inner = txt.findtext("Uformatert")
+            if inner:
+                add_part(inner)
+            add_part(txt.text or "")
+    else:
+        for u in post.findall(".//Uformatert"):
+            add_part(u.text or "")
+        for txt in post.findall(".//Tekst"):
+            if txt.get("OriginalFormat", "") == "RTF":
+                continue
+            add_part(txt.text or "")
 
-        prisinfo = post.find(tag("Prisinfo"))
-        enhet = ""
-        qty = 0.0
-        unit_price = 0.0
-        sum_amount = 0.0
-        if prisinfo is not None:
-            enhet = (prisinfo.findtext(tag("Enhet")) or "").strip()
-            qty = _to_float(prisinfo.findtext(tag("Mengde")))
-            unit_price = _to_float(prisinfo.findtext(tag("Enhetspris")))
-            sum_amount = _to_float(prisinfo.findtext(tag("Sum")))
-        if sum_amount == 0.0:
-            sum_amount = qty * unit_price
-
-        kapittel = ""
-        for pn in post.findall(f"{tag('Postnrdeler')}/{tag('Postnrdel')}"):
-            if (pn.findtext(tag("Type")) or "").strip() == "Type1":
-                kapittel = (pn.findtext(tag("Kode")) or "").strip()
-                break
-        if not kapittel and postnr:
-            kapittel = postnr.split(".")[0]
-
-        kapittel_navn = chapter_names.get(kapittel, "")
-        def parse_option(value: Any) -> bool:
-            text = str(value or "").strip().lower()
-            if text in {"true", "1", "ja", "yes"}:
-                return True
-            return False
-
-        is_option = bool(prisinfo is not None and parse_option(prisinfo.get("Opsjon")))
-
-        kode = post.find(tag("Kode"))
-        ns_code = ""
-        ns_title = ""
-        if kode is not None:
-            ns_code = (kode.findtext(tag("ID")) or "").strip()
-            ns_title = (kode.findtext(f"{tag('Kodetekst')}/{tag('Overskrift')}") or "").strip()
-            kodetekst = kode.find(tag("Kodetekst"))
-        else:
-            kodetekst = None
-
-        spec_parts: list[str] = []
-        seen = set()
-
-        def add_part(val: str):
-            val = val.strip()
-            if not val:
-                return
-            key = val.lower()
-            if key in seen:
-                return
-            seen.add(key)
-            spec_parts.append(val)
-
-        add_part(ns_title)
+    if not spec_parts and tekst_main:
         add_part(tekst_main)
 
-        if kodetekst is not None:
-            for u in kodetekst.findall(f".//{tag('Uformatert')}"):
-                add_part(u.text or "")
-            for txt in kodetekst.findall(f".//{tag('Tekst')}"):
-                if txt.get("OriginalFormat", "") == "RTF":
-                    continue
-                inner = txt.findtext(tag("Uformatert"))
-                if inner:
-                    add_part(inner)
-                add_part(txt.text or "")
-        else:
-            for u in post.findall(f".//{tag('Uformatert')}"):
-                add_part(u.text or "")
-            for txt in post.findall(f".//{tag('Tekst')}"):
-                if txt.get("OriginalFormat", "") == "RTF":
-                    continue
-                add_part(txt.text or "")
-
-        if not spec_parts and tekst_main:
-            add_part(tekst_main)
-
-        specification = "\n\n".join(spec_parts)
-        short_description = ns_title or (spec_parts[0] if spec_parts else tekst_main)
-
-        records.append(
-            {
-                "postnr": postnr,
-                "beskrivelse": short_description,
-                "enhet": enhet,
-                "qty": qty,
-                "unit_price": unit_price,
-                "sum_amount": sum_amount,
-                "kapittel": kapittel,
-                "kapittel_navn": kapittel_navn,
-                "ns_code": ns_code,
-                "ns_title": ns_title,
-                "specification": specification,
-                "is_option": is_option,
-            }
-        )
+    specification = "\n\n".join(spec_parts)
+    short_description = ns_title or (spec_parts[0] if spec_parts else tekst_main)
+
+    return {
+        "postnr": postnr,
+        "beskrivelse": short_description,
+        "enhet": enhet,
+        "qty": qty,
+        "unit_price": unit_price,
+        "sum_amount": sum_amount,
+        "kapittel": kapittel,
+        "ns_code": ns_code,
+        "ns_title": ns_title,
+        "specification": specification,
+        "is_option": is_option,
+    }
 
-    return pd.DataFrame.from_records(
-        records,
-        columns=[
-            "postnr",
-            "beskrivelse",
-            "enhet",
-            "qty",
-            "unit_price",
-            "sum_amount",
-            "kapittel",
-            "kapittel_navn",
-            "ns_code",
-            "ns_title",
-            "specification",
-            "is_option",
-        ],
-    )
 
+def _release_element(element: Any, parent: Any) -> None:
+    """Free a processed subtree while iterparse is still building the rest of the document."""
+    element.clear()
+    if hasattr(element, "getprevious"):
+        # lxml only allows unlinking siblings that come before the element being parsed.
+        while element.getprevious() is not None:
+            del parent[0]
+    else:
+        parent.remove(element)
 
-def _extract_company_name(data: bytes) -> str:
+
+def _stream_ns3459_posts(data: bytes) -> tuple[dict[str, str], list[dict[str, Any]]]:
+    """Read posts from a large document one at a time, dropping each subtree once it is recorded."""
+    chapter_names: dict[str, str] = {}
+    records: list[dict[str, Any]] = []
+    for element, ancestors in _iter_xml(data):
+        if element.tag == "Post":
+            records.append(_post_record(element))
+            if ancestors and not any(parent.tag == "Post" for parent in ancestors):
+                _release_element(element, ancestors[-1])
+        elif element.tag == "PostnrdelKode" and [parent.tag for parent in ancestors[1:4]] == [
+            "Pristilbud",
+            "ProsjektNS",
+            "Postnrplan",
+        ]:
+            entry = _chapter_name_entry(element)
+            if entry and entry[0] not in chapter_names:
+                chapter_names[entry[0]] = entry[1]
+    return chapter_names, records
+
+
+def _parse_ns3459_xml(data: bytes, name: str, root: Any = None) -> pd.DataFrame:
     try:
-        root = ET.fromstring(data)
-    except ET.ParseError:
-        return ""
+        if root is None and len(data) > _XML_STREAM_THRESHOLD:
+            chapter_names, records = _stream_ns3459_posts(data)
+        else:
+            if root is None:
+                root = _parse_xml_root(data)
+            chapter_names = {}
+            postnrplan = root.find("Pristilbud/ProsjektNS/Postnrplan")
+            if postnrplan is not None:
+                for element in postnrplan.iter("PostnrdelKode"):
+                    entry = _chapter_name_entry(element)
+                    if entry and entry[0] not in chapter_names:
+                        chapter_names[entry[0]] = entry[1]
+            records = [_post_record(post) for post in root.iter("Post")]
+    except ET.ParseError as exc:
+        raise HTTPException(status_code=400, detail=f"Could not read {name}: {exc}") from exc
 
-    ns_uri = ""
-    if root.tag.startswith("{"):
-        ns_uri = root.tag.split("}")[0][1:]
+    if not records:
+        raise HTTPException(status_code=400, detail=f"No posts found in {name}")
 
-    def tag(label: str) -> str:
-        return f"{{{ns_uri}}}{label}" if ns_uri else label
+    df = pd.DataFrame.from_records(records, columns=_NS3459_COLUMNS)
+    df["kapittel_navn"] = df["kapittel"].map(chapter_names).fillna("")
+    df["is_option"] = df["is_option"].astype(bool)
+    return _categorize_keys(_clean_text_columns(df))
 
-    paths = [
-        f"{tag('Pristilbud')}/{tag('Generelt')}/{tag('Avsender')}/{tag('Firma')}/{tag('Navn')}",
-        f"{tag('Prisforesporsel')}/{tag('Generelt')}/{tag('Avsender')}/{tag('Firma')}/{tag('Navn')}",
-        f"{tag('ProsjektNS')}/{tag('Generelt')}/{tag('Avsender')}/{tag('Firma')}/{tag('Navn')}",
-    ]
-    for path in paths:
+
+def _extract_company_name(data: bytes, root: Any = None) -> str:
+    if root is None and len(data) > _XML_STREAM_THRESHOLD:
+        # Sender info sits near the top of the document, so stop as soon as the preferred path is found.
+        found: dict[str, str] = {}
+        try:
+            for element, ancestors in _iter_xml(data):
+                if element.tag == "Navn":
+                    path = "/".join([parent.tag for parent in ancestors[1:]] + ["Navn"])
+                    if path in _COMPANY_NAME_PATHS and path not in found:
+                        found[path] = element.text or ""
+                        if path == _COMPANY_NAME_PATHS[0] and found[path]:
+                            break
+                element.clear()
+        except ET.ParseError:
+            return ""
+        for path in _COMPANY_NAME_PATHS:
+            if found.get(path):
+                return found[path].strip()
+        return ""
+
+    if root is None:
+        try:
+            root = _parse_xml_root(data)
+        except ET.ParseError:
+            return ""
+
+    for path in _COMPANY_NAME_PATHS:
         value = root.findtext(path)
         if value:
             return value.strip()
     return ""
 
 
-def _to_records(df: pd.DataFrame) -> list[dict[str, Any]]:
-    return df.replace({pd.NA: None}).to_dict(orient="records")
-
-
-def _collect_chapter_titles(bids: dict[str, pd.DataFrame]) -> dict[str, str]:
-    titles: dict[str, str] = {}
-
-    def normalize(text: str) -> str:
-        collapsed = re.sub(r"\s+", " ", text.strip())
-        collapsed = collapsed.rstrip(" .;-")
-        if not collapsed:
-            return ""
-        letters = [ch for ch in collapsed if ch.isalpha()]
-        if letters:
-            upper_ratio = sum(ch.isupper() for ch in letters) / len(letters)
-        else:
-            upper_ratio = 0.0
-        if upper_ratio >= 0.6:
-            lowered = collapsed.lower()
-            parts = re.split(r"([-/–—])", lowered)
-            rebuilt = "".join(part.title() if idx % 2 == 0 else part for idx, part in enumerate(parts))
-            collapsed = rebuilt
-        return collapsed
-
-    for df in bids.values():
-        for _, row in df.iterrows():
-            code = str(row.get("kapittel") or "").strip()
-            if not code or code in titles:
-                continue
-
-            chapter_name = normalize(str(row.get("kapittel_navn") or ""))
-            if chapter_name:
-                titles[code] = chapter_name
-                continue
-
-            candidates: list[str] = []
-            ns_title = str(row.get("ns_title") or "").strip()
-            if ns_title:
-                candidates.append(ns_title)
+def _read_xml_bid(data: bytes, name: str) -> tuple[str, pd.DataFrame]:
+    """Parse an NS3459 bid and its sender company; large files are streamed instead of kept as a tree."""
+    root = None
+    if len(data) <= _XML_STREAM_THRESHOLD:
+        try:
+            root = _parse_xml_root(data)
+        except ET.ParseError as exc:
+            raise HTTPException(status_code=400, detail=f"Could not read {name}: {exc}") from exc
+    df = _parse_ns3459_xml(data, name, root)
+    try:
+        company = _extract_company_name(data, root)
+    except Exception:
+        company = ""
+    return company, df
 
-            specification = str(row.get("specification") or "").strip()
-            if specification:
-                spec_line = specification.splitlines()[0].strip()
-                if spec_line:
-                    candidates.append(spec_line)
 
-            description = str(row.get("beskrivelse") or "").strip()
-            if description:
-                candidates.append(description)
+def _to_records(df: pd.DataFrame) -> list[dict[str, Any]]:
+    return df.replace({pd.NA: None}).to_dict(orient="records")
 
-            for candidate in candidates:
-                if not candidate or candidate.lower() == "sum":
-                    continue
 
-                normalized = normalize(candidate)
-                if not normalized:
-                    continue
+def _normalize_titles(values: pd.Series) -> pd.Series:
+    """Collapse whitespace, drop trailing punctuation and title-case mostly upper-case text."""
+    collapsed = values.str.strip().str.replace(_WS_RE, " ", regex=True).str.rstrip(" .;-")
+    letters = collapsed.str.count(_LETTER_RE)
+    uppers = collapsed.str.count(_UPPER_RE)
+    upper_ratio = uppers / letters.where(letters > 0)
+    return collapsed.mask(upper_ratio >= 0.6, collapsed.str.lower().str.title())
 
-                text = normalized if len(normalized) <= 120 else f"{normalized[:117]}..."
-                titles[code] = text
-                break
 
-    return titles
+def _collect_chapter_titles(bids: dict[str, pd.DataFrame]) -> dict[str, str]:
+    columns = ["kapittel", "kapittel_navn", "ns_title", "specification", "beskrivelse"]
+    frames = [df.reindex(columns=columns) for df in bids.values() if not df.empty]
+    if not frames:
+        return {}
+    combined = pd.concat(frames, ignore_index=True)
+    combined = combined.astype(str).where(combined.notna(), "")
+    combined = combined[combined["kapittel"] != ""].drop_duplicates()
+
+    # Fallback titles come from the NS title, the first specification line or the description.
+    spec_lines = combined["specification"].str.split(_LINE_BREAK_RE, n=1, regex=True)
+    candidates = [
+        combined["ns_title"],
+        spec_lines.str[0].str.strip(),
+        combined["beskrivelse"],
+    ]
+    fallback = pd.Series("", index=combined.index)
+    for candidate in reversed(candidates):
+        normalized = _normalize_titles(candidate.where(candidate.str.lower() != "sum", ""))
+        fallback = normalized.where(normalized != "", fallback)
+    fallback = fallback.where(fallback.str.len() <= 120, fallback.str.slice(0, 117) + "...")
+
+    chapter_names = _normalize_titles(combined["kapittel_navn"])
+    combined["title"] = chapter_names.where(chapter_names != "", fallback)
+    found = combined[combined["title"] != ""].drop_duplicates("kapittel")
+    return dict(zip(found["kapittel"], found["title"]))
+
+
+def _collect_post_meta(bids: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """Pick the first non-empty descriptive value per postnr, taking bids in upload order."""
+    text_columns = ["kapittel", "kapittel_navn", "ns_code", "specification", "enhet"]
+    frames = [df.reindex(columns=["postnr", *text_columns, "qty"]) for df in bids if not df.empty]
+    if not frames:
+        return pd.DataFrame(columns=["postnr", *text_columns, "qty"])
+    combined = pd.concat(frames, ignore_index=True)
+
+    text = combined[["postnr", *text_columns]]
+    meta = text.astype(str).where(text.notna(), "")
+    meta = meta.where(meta != "")
+    qty = pd.to_numeric(combined["qty"], errors="coerce")
+    meta["qty"] = qty.where(qty != 0)
+    meta = meta.dropna(subset=["postnr"]).groupby("postnr", sort=False).first()
+    meta[text_columns] = meta[text_columns].fillna("")
+    meta["qty"] = meta["qty"].fillna(0.0)
+    return meta.reset_index()
 
 
 def _aggregate_bid_rows(df: pd.DataFrame, unit_label: str, sum_label: str) -> pd.DataFrame:
-    rows: list[dict[str, Any]] = []
-    for postnr, group in df.groupby("postnr", dropna=False):
-        qty = pd.to_numeric(group.get("qty", pd.Series(dtype=float)), errors="coerce")
-        unit_price = pd.to_numeric(group.get("unit_price", pd.Series(dtype=float)), errors="coerce")
-        sum_amount = pd.to_numeric(group.get("sum_amount", pd.Series(dtype=float)), errors="coerce")
-
-        mask = qty.notna() & unit_price.notna()
-        if mask.any():
-            qty_sum = float(qty[mask].sum())
-            if qty_sum > 0:
-                weighted_price = float((unit_price[mask] * qty[mask]).sum() / qty_sum)
-            else:
-                weighted_price = float(unit_price[mask].mean()) if unit_price[mask].notna().any() else None
-        elif unit_price.notna().any():
-            weighted_price = float(unit_price.mean(skipna=True))
-        else:
-            weighted_price = None
+    missing = pd.Series(np.nan, index=df.index)
+    qty = pd.to_numeric(df["qty"], errors="coerce") if "qty" in df.columns else missing
+    unit_price = pd.to_numeric(df["unit_price"], errors="coerce") if "unit_price" in df.columns else missing
+    sum_amount = pd.to_numeric(df["sum_amount"], errors="coerce") if "sum_amount" in df.columns else missing
+
+    # Posts with both qty and unit price get a qty-weighted price; the rest fall back to a plain mean.
+    valid = qty.notna() & unit_price.notna()
+    grouped = pd.DataFrame(
+        {
+            "has_valid": valid,
+            "qty": qty.where(valid),
+            "weighted": (unit_price * qty).where(valid),
+            "valid_price": unit_price.where(valid),
+            "price": unit_price,
+            "sum": sum_amount,
+        }
+    ).groupby(df["postnr"], dropna=False, observed=True)
+    qty_sum = grouped["qty"].sum()
+    weighted_price = (grouped["weighted"].sum() / qty_sum.where(qty_sum > 0)).fillna(grouped["valid_price"].mean())
+    weighted_price = weighted_price.where(grouped["has_valid"].any(), grouped["price"].mean())
+    total_sum = grouped["sum"].sum(min_count=1)
+
+    result = pd.DataFrame(
+        {
+            "postnr": weighted_price.index.astype(str),
+            unit_label: weighted_price.to_numpy(),
+            sum_label: total_sum.to_numpy(),
+        }
+    )
+    result = result[result[unit_label].notna() | result[sum_label].notna()]
+    if result.empty:
+        return pd.DataFrame(columns=["postnr", unit_label, sum_label])
+    return result.reset_index(drop=True)
 
-        total_sum = float(sum_amount.sum(skipna=True)) if sum_amount.notna().any() else None
 
-        if weighted_price is None and total_sum is None:
-            continue
+def _split_options(df: pd.DataFrame) -> tuple[pd.DataFrame, float, float]:
+    """Split a bid into its base rows plus the base and option sum totals, using one option mask."""
+    option_mask = df["is_option"].to_numpy(dtype=bool)
+    amounts = df["sum_amount"].to_numpy(dtype=np.float64)
+    base = df.loc[~option_mask, df.columns.intersection(_BASE_BID_COLUMNS, sort=False)]
+    return base, float(np.nansum(amounts[~option_mask])), float(np.nansum(amounts[option_mask]))
 
-        rows.append(
-            {
-                "postnr": str(postnr),
-                unit_label: weighted_price,
-                sum_label: total_sum,
-            }
-        )
-    if not rows:
-        return pd.DataFrame(columns=["postnr", unit_label, sum_label])
-    return pd.DataFrame(rows)
+
+def _build_comparison_matrix(base_bids: dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """Aggregate every bid per postnr and lay the providers out side by side in one reshape."""
+    columns = [column for name in base_bids for column in (f"{name} (enhetspris)", f"{name} (sum)")]
+    parts: list[pd.DataFrame] = []
+    for name, df in base_bids.items():
+        part = _aggregate_bid_rows(df, "unit_price", "sum_amount")
+        if not part.empty:
+            parts.append(part.assign(provider=name))
+    if not parts:
+        return pd.DataFrame(columns=["postnr", *columns])
+
+    wide = pd.concat(parts, ignore_index=True).set_index(["postnr", "provider"]).unstack("provider")
+    wide.columns = [
+        f"{provider} ({'enhetspris' if value == 'unit_price' else 'sum'})" for value, provider in wide.columns
+    ]
+    return wide.reindex(columns=columns).reset_index()
+
+
+def _chapter_totals(base_bids: dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """Sum base amounts per kapittel with one column per provider, 0.0 where a provider has no posts."""
+    parts = {name: df[["kapittel", "sum_amount"]] for name, df in base_bids.items() if not df.empty}
+    if not parts:
+        return pd.DataFrame(columns=["kapittel"])
+    combined = pd.concat(parts, names=["provider"]).reset_index(level="provider")
+    combined["kapittel"] = combined["kapittel"].astype(str)
+    chapter = (
+        combined.groupby(["kapittel", "provider"], sort=False)["sum_amount"]
+        .sum()
+        .unstack("provider", fill_value=0.0)
+        .reindex(columns=list(parts))
+        .sort_index()
+    )
+    return chapter.rename_axis(columns=None).reset_index()
 
 
+@lru_cache(maxsize=256)
 def _lighten_hex(color: str, factor: float) -> str:
     color = color.lstrip("#")
     if len(color) != 6:
@@ -430,6 +599,34 @@ def _lighten_hex(color: str, factor: float) -> str:
     return f"{max(0, min(255, r)):02X}{max(0, min(255, g)):02X}{max(0, min(255, b)):02X}"
 
 
+def _register_cell_styles(
+    workbook: Workbook,
+    prefix: str,
+    specs: dict[str, dict[str, Any]],
+    border: Border,
+) -> dict[tuple[str, bool], str]:
+    """Register one bordered named style per cell kind, plus a bold variant for SUM rows."""
+    styles: dict[tuple[str, bool], str] = {}
+    for kind, spec in specs.items():
+        for bold in (False, True):
+            style = NamedStyle(
+                name=f"{prefix}_{kind}_bold" if bold else f"{prefix}_{kind}",
+                font=Font(bold=True) if bold else copy(DEFAULT_FONT),
+                border=border,
+                **spec,
+            )
+            workbook.add_named_style(style)
+            styles[(kind, bold)] = style.name
+    return styles
+
+
+def _column_width(values: pd.Series, header: str, minimum: int) -> int:
+    """Excel column width that fits the header and the longest rendered value."""
+    lengths = values[values.notna()].astype(str).str.len()
+    longest = int(lengths.max()) if not lengths.empty else 0
+    return max(minimum, max(len(str(header)), longest) + 2)
+
+
 def _build_matrix_excel(
     matrix: pd.DataFrame,
     sum_columns: list[str],
@@ -440,53 +637,63 @@ def _build_matrix_excel(
         return ""
 
     buffer = io.BytesIO()
-    workbook = Workbook()
-    worksheet = workbook.active
-    worksheet.title = "Sammenligning per post"
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Sammenligning per post")
 
     headers = list(matrix.columns)
-    worksheet.append(headers)
-
-    default_header_fill = PatternFill(fill_type="solid", start_color="E2E8F0", end_color="E2E8F0")
-    header_font = Font(bold=True, color="0F172A")
-    header_alignment = Alignment(horizontal="center", vertical="center")
-    for cell in worksheet[1]:
-        cell.font = header_font
-        cell.alignment = header_alignment
-
     currency_columns = set(sum_columns + unit_columns + ["lavest_sum", "std_avvik", "snitt"])
     percent_columns = {"std_pct"}
     z_score_columns = {col for col in matrix.columns if col.endswith("(z-score)")}
 
-    for record in matrix.to_dict(orient="records"):
-        row_values: list[Any] = []
-        for column in headers:
-            value = record.get(column)
-            if isinstance(value, np.generic):
-                value = value.item()
-            if value is None or (isinstance(value, float) and pd.isna(value)):
-                row_values.append(None)
-                continue
-            if column in percent_columns and isinstance(value, (int, float)):
-                row_values.append(float(value) / 100.0)
-            else:
-                row_values.append(value)
-        worksheet.append(row_values)
-
-    worksheet.freeze_panes = "A2"
-    worksheet.auto_filter.ref = worksheet.dimensions
-
     border_side = Side(style="thin", color="CBD5F5")
     table_border = Border(left=border_side, right=border_side, top=border_side, bottom=border_side)
     right_alignment = Alignment(horizontal="right")
-    percent_alignment = Alignment(horizontal="right")
+    styles = _register_cell_styles(
+        workbook,
+        "matrix",
+        {
+            "empty": {},
+            "text": {},
+            "number": {"alignment": right_alignment},
+            "currency": {"alignment": right_alignment, "number_format": '#,##0.00 "kr"'},
+            "percent": {"alignment": right_alignment, "number_format": "0.00%"},
+            "z_score": {"alignment": right_alignment, "number_format": "0.00"},
+        },
+        table_border,
+    )
 
-    for row in worksheet.iter_rows(min_row=1, max_row=worksheet.max_row, min_col=1, max_col=len(headers)):
-        for cell in row:
-            cell.border = table_border
+    column_kinds: list[str] = []
+    for column in headers:
+        if column in currency_columns:
+            column_kinds.append("currency")
+        elif column in percent_columns:
+            column_kinds.append("percent")
+        elif column in z_score_columns:
+            column_kinds.append("z_score")
+        elif column != "postnr" and column != "vinner":
+            column_kinds.append("number")
+        else:
+            column_kinds.append("text")
 
+    # Write-only sheets emit column widths and panes before the first row, so set them up front.
     for index, column in enumerate(headers, start=1):
-        header_cell = worksheet.cell(row=1, column=index)
+        values = matrix[column]
+        if column in percent_columns:
+            numbers = pd.to_numeric(values, errors="coerce")
+            values = numbers.map("{:.2f} %".format).where(numbers.notna(), values)
+        worksheet.column_dimensions[get_column_letter(index)].width = _column_width(values, column, 14)
+    worksheet.freeze_panes = "A2"
+    worksheet.auto_filter.ref = f"A1:{get_column_letter(len(headers))}{len(matrix) + 1}"
+
+    default_header_fill = PatternFill(fill_type="solid", start_color="E2E8F0", end_color="E2E8F0")
+    header_font = Font(bold=True, color="0F172A")
+    header_alignment = Alignment(horizontal="center", vertical="center")
+    header_cells: list[WriteOnlyCell] = []
+    for column in headers:
+        header_cell = WriteOnlyCell(worksheet, value=column)
+        header_cell.font = header_font
+        header_cell.alignment = header_alignment
+        header_cell.border = table_border
         if column_colors and column in column_colors:
             base = column_colors[column]
             if column in unit_columns:
@@ -498,55 +705,28 @@ def _build_matrix_excel(
             header_cell.fill = PatternFill(fill_type="solid", start_color=fill_color, end_color=fill_color)
         else:
             header_cell.fill = default_header_fill
-
-        column_letter = get_column_letter(index)
-        max_length = 0
-        for cell in worksheet[column_letter]:
-            if cell.value is None:
-                continue
-            display_value = cell.value
-            if column in percent_columns and cell.row > 1 and isinstance(display_value, (int, float)):
-                display_value = f"{display_value * 100:.2f} %"
-            length = len(str(display_value))
-            max_length = max(max_length, length)
-        worksheet.column_dimensions[column_letter].width = max(14, max_length + 2)
-
-        if column in currency_columns:
-            for cell in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row, min_col=index, max_col=index):
-                target = cell[0]
-                if target.value is None:
-                    continue
-                target.number_format = '#,##0.00 "kr"'
-                target.alignment = right_alignment
-        elif column in percent_columns:
-            for cell in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row, min_col=index, max_col=index):
-                target = cell[0]
-                if target.value is None:
-                    continue
-                target.number_format = "0.00%"
-                target.alignment = percent_alignment
-        elif column in z_score_columns:
-            for cell in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row, min_col=index, max_col=index):
-                target = cell[0]
-                if target.value is None:
-                    continue
-                target.number_format = "0.00"
-                target.alignment = right_alignment
-        elif column != "postnr" and column != "vinner":
-            for cell in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row, min_col=index, max_col=index):
-                target = cell[0]
-                if target.value is None:
-                    continue
-                target.alignment = right_alignment
-
-    bold_font = Font(bold=True)
-    for row in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row):
-        if str(row[0].value).strip().upper() == "SUM":
-            for cell in row:
-                cell.font = bold_font
+        header_cells.append(header_cell)
+    worksheet.append(header_cells)
+
+    is_percent = [column in percent_columns for column in headers]
+    for record in matrix.itertuples(index=False, name=None):
+        bold = str(record[0]).strip().upper() == "SUM"
+        cells: list[WriteOnlyCell] = []
+        for kind, percent, value in zip(column_kinds, is_percent, record):
+            if isinstance(value, np.generic):
+                value = value.item()
+            if value is None or (isinstance(value, float) and pd.isna(value)):
+                value = None
+                kind = "empty"
+            elif percent and isinstance(value, (int, float)):
+                value = float(value) / 100.0
+            cell = WriteOnlyCell(worksheet, value=value)
+            cell.style = styles[(kind, bold)]
+            cells.append(cell)
+        worksheet.append(cells)
 
     workbook.save(buffer)
-    return base64.b64encode(buffer.getvalue()).decode("ascii")
+    return base64.b64encode(buffer.getbuffer()).decode("ascii")
 
 
 def _build_chapter_excel(chapter: pd.DataFrame) -> str:
@@ -554,84 +734,74 @@ def _build_chapter_excel(chapter: pd.DataFrame) -> str:
         return ""
 
     buffer = io.BytesIO()
-    workbook = Workbook()
-    worksheet = workbook.active
-    worksheet.title = "Kapitteloppsummering"
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Kapitteloppsummering")
 
     headers = list(chapter.columns)
-    worksheet.append(headers)
-
-    header_fill = PatternFill(fill_type="solid", start_color="E2E8F0", end_color="E2E8F0")
-    header_font = Font(bold=True, color="0F172A")
-    header_alignment = Alignment(horizontal="center", vertical="center")
-    for cell in worksheet[1]:
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = header_alignment
+    border_side = Side(style="thin", color="CBD5F5")
+    table_border = Border(left=border_side, right=border_side, top=border_side, bottom=border_side)
+    right_alignment = Alignment(horizontal="right")
+    styles = _register_cell_styles(
+        workbook,
+        "chapter",
+        {
+            "plain": {},
+            "number": {"alignment": right_alignment, "number_format": "#,##0.00"},
+            "percent": {"alignment": right_alignment, "number_format": "0.00%"},
+        },
+        table_border,
+    )
 
     string_columns = {"kapittel", "kapittel_navn", "laveste_tilbyder"}
     percent_columns = {"spann_pct"}
     numeric_columns = [col for col in headers if col not in string_columns.union(percent_columns)]
-    for record in chapter.to_dict(orient="records"):
-        row_values: list[Any] = []
-        for column in headers:
-            value = record.get(column)
+    for index, column in enumerate(headers, start=1):
+        values = chapter[column]
+        if column in percent_columns or column in numeric_columns:
+            numbers = pd.to_numeric(values, errors="coerce")
+            if column in percent_columns:
+                numbers = numbers / 100.0
+            values = numbers.where(numbers.notna(), values)
+        worksheet.column_dimensions[get_column_letter(index)].width = _column_width(values, column, 12)
+    worksheet.freeze_panes = "A2"
+
+    header_fill = PatternFill(fill_type="solid", start_color="E2E8F0", end_color="E2E8F0")
+    header_font = Font(bold=True, color="0F172A")
+    header_alignment = Alignment(horizontal="center", vertical="center")
+    header_cells: list[WriteOnlyCell] = []
+    for column in headers:
+        header_cell = WriteOnlyCell(worksheet, value=column)
+        header_cell.fill = header_fill
+        header_cell.font = header_font
+        header_cell.alignment = header_alignment
+        header_cell.border = table_border
+        header_cells.append(header_cell)
+    worksheet.append(header_cells)
+
+    column_kinds = [
+        "number" if column in numeric_columns else "percent" if column in percent_columns else "plain"
+        for column in headers
+    ]
+    is_percent = [column in percent_columns for column in headers]
+    is_numeric = [column in numeric_columns for column in headers]
+    for record in chapter.itertuples(index=False, name=None):
+        bold = str(record[0]).strip().upper() == "SUM"
+        cells: list[WriteOnlyCell] = []
+        for kind, percent, numeric, value in zip(column_kinds, is_percent, is_numeric, record):
             if isinstance(value, np.generic):
                 value = value.item()
-            if column in percent_columns and value not in (None, "", "SUM"):
-                try:
-                    row_values.append(float(value) / 100.0)
-                    continue
-                except (TypeError, ValueError):
-                    pass
-            if column in numeric_columns and value not in (None, "", "SUM"):
+            if (percent or numeric) and value not in (None, "", "SUM"):
                 try:
-                    row_values.append(float(value))
-                    continue
+                    value = float(value) / 100.0 if percent else float(value)
                 except (TypeError, ValueError):
                     pass
-            row_values.append(value)
-        worksheet.append(row_values)
-
-    worksheet.freeze_panes = "A2"
-
-    border_side = Side(style="thin", color="CBD5F5")
-    table_border = Border(left=border_side, right=border_side, top=border_side, bottom=border_side)
-    for row in worksheet.iter_rows(min_row=1, max_row=worksheet.max_row, min_col=1, max_col=len(headers)):
-        for cell in row:
-            cell.border = table_border
-
-    for index, column in enumerate(headers, start=1):
-        column_letter = get_column_letter(index)
-        max_length = 0
-        for cell in worksheet[column_letter]:
-            if cell.value is None:
-                continue
-            length = len(str(cell.value))
-            max_length = max(max_length, length)
-        worksheet.column_dimensions[column_letter].width = max(12, max_length + 2)
-
-        if column in numeric_columns:
-            for cell in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row, min_col=index, max_col=index):
-                target = cell[0]
-                if isinstance(target.value, (int, float)):
-                    target.number_format = '#,##0.00'
-                    target.alignment = Alignment(horizontal="right")
-        elif column in percent_columns:
-            for cell in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row, min_col=index, max_col=index):
-                target = cell[0]
-                if isinstance(target.value, (int, float)):
-                    target.number_format = '0.00%'
-                    target.alignment = Alignment(horizontal="right")
-
-    bold_font = Font(bold=True)
-    for row in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row):
-        if str(row[0].value).strip().upper() == "SUM":
-            for cell in row:
-                cell.font = bold_font
+            cell = WriteOnlyCell(worksheet, value=value)
+            cell.style = styles[(kind if isinstance(value, (int, float)) else "plain", bold)]
+            cells.append(cell)
+        worksheet.append(cells)
 
     workbook.save(buffer)
-    return base64.b64encode(buffer.getvalue()).decode("ascii")
+    return base64.b64encode(buffer.getbuffer()).decode("ascii")
 
 
 def _format_parenthesized_currency(value: Any) -> str:
@@ -643,6 +813,99 @@ def _format_parenthesized_currency(value: Any) -> str:
     return f"(kr {formatted})"
 
 
+# Fixed sheets after the per-bid sheets in the full report; bid sheet names must not clash with them.
+_SUMMARY_SHEETS = ("Sammenligning", "Kapittel")
+
+
+def _unique_truncate(names: Iterable[str], limit: int = 31, reserved: Iterable[str] = ()) -> list[str]:
+    """Cut names to Excel's sheet-name limit, suffixing "~1", "~2", ... where the cut names collide."""
+    # Excel compares sheet names case-insensitively.
+    taken = {name.casefold() for name in reserved}
+    unique_names: list[str] = []
+    for name in names:
+        candidate = name[:limit]
+        counter = 0
+        while candidate.casefold() in taken:
+            counter += 1
+            suffix = f"~{counter}"
+            candidate = name[: limit - len(suffix)] + suffix
+        taken.add(candidate.casefold())
+        unique_names.append(candidate)
+    return unique_names
+
+
+def _append_frame(worksheet: Any, frame: pd.DataFrame, header_style: str) -> None:
+    """Stream a DataFrame into a write-only sheet: a styled header row, then the values with NaN as blanks."""
+    header_cells: list[WriteOnlyCell] = []
+    for column in frame.columns:
+        header_cell = WriteOnlyCell(worksheet, value=column)
+        header_cell.style = header_style
+        header_cells.append(header_cell)
+    worksheet.append(header_cells)
+    values = frame.astype(object).where(frame.notna(), None)
+    for record in values.itertuples(index=False, name=None):
+        worksheet.append(record)
+
+
+def _build_report_excel(bids: dict[str, pd.DataFrame], matrix: pd.DataFrame, chapter: pd.DataFrame) -> str:
+    buffer = io.BytesIO()
+    workbook = Workbook(write_only=True)
+    # Same header look as DataFrame.to_excel: bold, thin borders, centered.
+    thin_side = Side(style="thin")
+    styles = _register_cell_styles(
+        workbook,
+        "report",
+        {"header": {"alignment": Alignment(horizontal="center", vertical="top")}},
+        Border(left=thin_side, right=thin_side, top=thin_side, bottom=thin_side),
+    )
+    header_style = styles[("header", True)]
+
+    sheet_names = _unique_truncate(bids, reserved=_SUMMARY_SHEETS)
+    for sheet_name, df in zip(sheet_names, bids.values()):
+        sheet_df = df[[column for column in df.columns if column != "is_option"]]
+        option_mask = df["is_option"].to_numpy(dtype=bool)
+        if option_mask.any():
+            # Option rows show their amounts as "(kr 1 234,50)" text; only those two columns are rebuilt.
+            formatted: dict[str, np.ndarray] = {}
+            for col in ["unit_price", "sum_amount"]:
+                if col in sheet_df.columns:
+                    values = sheet_df[col].to_numpy(dtype=object, copy=True)
+                    values[option_mask] = [
+                        _format_parenthesized_currency(value) if pd.notna(value) else ""
+                        for value in values[option_mask]
+                    ]
+                    formatted[col] = values
+            sheet_df = sheet_df.assign(**formatted)
+        _append_frame(workbook.create_sheet(sheet_name), sheet_df, header_style)
+    # The matrix is built from the aggregated base rows, so it never carries is_option.
+    matrix_sheet, chapter_sheet = _SUMMARY_SHEETS
+    _append_frame(workbook.create_sheet(matrix_sheet), matrix, header_style)
+    _append_frame(workbook.create_sheet(chapter_sheet), chapter, header_style)
+
+    workbook.save(buffer)
+    return base64.b64encode(buffer.getbuffer()).decode("ascii")
+
+
+def _unique_name(candidate: str, name_counts: Counter[str], taken: Container[str]) -> str:
+    """Suffix repeated provider names with " (2)", " (3)", ... in the order they arrive."""
+    name_counts[candidate] += 1
+    count = name_counts[candidate]
+    unique_name = candidate if count == 1 else f"{candidate} ({count})"
+    # A provider literally called "Name (2)" can still collide with a generated suffix.
+    while unique_name in taken:
+        name_counts[candidate] += 1
+        unique_name = f"{candidate} ({name_counts[candidate]})"
+    return unique_name
+
+
+def _load_bid(name: str, data: bytes) -> tuple[str, pd.DataFrame]:
+    """Parse one upload and return the provider name candidate with its normalized rows."""
+    if name.lower().endswith(".xml"):
+        company, df = _read_xml_bid(data, name)
+        return company or name, df
+    return name, _normalize_columns(_read_tabular(name, data))
+
+
 @app.post("/api/bid-compare")
 async def bid_compare(files: list[UploadFile] = File(...)) -> dict[str, Any]:
     if not files:
@@ -650,36 +913,28 @@ async def bid_compare(files: list[UploadFile] = File(...)) -> dict[str, Any]:
 
     bids: dict[str, pd.DataFrame] = {}
     errors: list[str] = []
+    name_counts: Counter[str] = Counter()
 
-    for upload in files:
-        name = upload.filename or f"bid_{len(bids) + 1}"
-        data = await upload.read()
+    payloads = await asyncio.gather(*(upload.read() for upload in files))
+    names = [upload.filename or f"bid_{index}" for index, upload in enumerate(files, start=1)]
+    loaded = await asyncio.gather(
+        *(asyncio.to_thread(_load_bid, name, data) for name, data in zip(names, payloads) if data),
+        return_exceptions=True,
+    )
+    results = iter(loaded)
+    for name, data in zip(names, payloads):
         if not data:
             errors.append(f"{name} is empty.")
             continue
-        try:
-            if name.lower().endswith(".xml"):
-                df_clean = _parse_ns3459_xml(data, name)
-                try:
-                    candidate = _extract_company_name(data) or name
-                except Exception:
-                    candidate = name
-            else:
-                df_raw = _read_tabular(name, data)
-                df_clean = _normalize_columns(df_raw)
-                candidate = name
-
-            unique_name = candidate
-            counter = 1
-            while unique_name in bids:
-                counter += 1
-                unique_name = f"{candidate} ({counter})"
-
-            bids[unique_name] = df_clean
-        except HTTPException as exc:
-            errors.append(exc.detail)
-        except Exception as exc:
-            errors.append(f"Could not read {name}: {exc}")
+        result = next(results)
+        if isinstance(result, HTTPException):
+            errors.append(result.detail)
+            continue
+        if isinstance(result, Exception):
+            errors.append(f"Could not read {name}: {result}")
+            continue
+        candidate, df_clean = result
+        bids[_unique_name(candidate, name_counts, bids)] = df_clean
 
     if not bids:
         raise HTTPException(status_code=400, detail="Could not read any files.")
@@ -688,89 +943,30 @@ async def bid_compare(files: list[UploadFile] = File(...)) -> dict[str, Any]:
     normalized = {name: _to_records(df) for name, df in bids.items()}
 
     # Comparison matrix
-    matrix = pd.DataFrame(columns=["postnr"])
     provider_order: list[str] = []
     unit_columns: list[str] = []
     sum_columns: list[str] = []
     sum_column_provider: dict[str, str] = {}
-    post_meta: dict[str, dict[str, Any]] = {}
+    totals: dict[str, float] = {}
     option_totals: dict[str, float] = {}
     base_bids: dict[str, pd.DataFrame] = {}
 
-    for idx, (name, df) in enumerate(bids.items()):
+    for name, df in bids.items():
         provider_order.append(name)
-        df_base = df[df["is_option"] != True].copy()
-        base_bids[name] = df_base
-        option_totals[name] = float(df[df["is_option"] == True]["sum_amount"].sum())
+        base_bids[name], totals[name], option_totals[name] = _split_options(df)
 
         unit_col = f"{name} (enhetspris)"
         sum_col = f"{name} (sum)"
-        part = _aggregate_bid_rows(df_base, unit_col, sum_col)
-        if idx == 0:
-            matrix = part
-        else:
-            matrix = matrix.merge(part, on="postnr", how="outer")
-        if unit_col not in matrix.columns:
-            matrix[unit_col] = 0.0
-        if sum_col not in matrix.columns:
-            matrix[sum_col] = 0.0
         unit_columns.append(unit_col)
         sum_columns.append(sum_col)
         sum_column_provider[sum_col] = name
 
-        for _, row in df_base.iterrows():
-            postnr = str(row.get("postnr") or "").strip()
-            if not postnr:
-                continue
-            entry = post_meta.setdefault(
-                postnr,
-                {
-                    "kapittel": "",
-                    "kapittel_navn": "",
-                    "ns_code": "",
-                    "specification": "",
-                    "enhet": "",
-                    "qty": None,
-                },
-            )
-            kapittel = str(row.get("kapittel") or "").strip()
-            kapittel_navn = str(row.get("kapittel_navn") or "").strip()
-            if kapittel and not entry["kapittel"]:
-                entry["kapittel"] = kapittel
-            if kapittel_navn and not entry["kapittel_navn"]:
-                entry["kapittel_navn"] = kapittel_navn
-            if not entry["ns_code"]:
-                ns_code = str(row.get("ns_code") or "").strip()
-                if ns_code:
-                    entry["ns_code"] = ns_code
-            if not entry["specification"]:
-                specification = str(row.get("specification") or "").strip()
-                if specification:
-                    entry["specification"] = specification
-            if not entry["enhet"]:
-                enhet = str(row.get("enhet") or "").strip()
-                if enhet:
-                    entry["enhet"] = enhet
-            qty_value = row.get("qty")
-            if entry["qty"] in (None, 0, 0.0):
-                qty_float = _to_float(qty_value)
-                entry["qty"] = qty_float if entry["qty"] is None or qty_float else entry["qty"]
-
+    matrix = _build_comparison_matrix(base_bids)
     if not matrix.empty:
         matrix["postnr"] = matrix["postnr"].astype(str)
 
-    if post_meta:
-        meta_df = pd.DataFrame.from_dict(post_meta, orient="index").reset_index().rename(
-            columns={
-                "index": "postnr",
-                "kapittel": "kapittel",
-                "kapittel_navn": "kapittel_navn",
-                "ns_code": "ns_code",
-                "specification": "specification",
-                "enhet": "enhet",
-                "qty": "qty",
-            }
-        )
+    meta_df = _collect_post_meta(base_bids.values())
+    if not meta_df.empty:
         matrix = matrix.merge(meta_df, on="postnr", how="left")
         for column in ["ns_code", "specification", "enhet", "kapittel", "kapittel_navn"]:
             if column in matrix.columns:
@@ -806,28 +1002,41 @@ async def bid_compare(files: list[UploadFile] = File(...)) -> dict[str, Any]:
     active_unit_columns = [col for col in unit_columns if col in matrix.columns]
 
     if active_sum_columns:
-        sums_df = matrix[active_sum_columns].apply(pd.to_numeric, errors="coerce")
-        min_indices = sums_df.idxmin(axis=1, skipna=True)
-        matrix["vinner"] = min_indices.map(sum_column_provider).fillna("")
-        matrix["lavest_sum"] = sums_df.min(axis=1, skipna=True).fillna(0.0)
-        std_series = sums_df.std(axis=1, skipna=True)
-        matrix["std_avvik"] = std_series.fillna(0.0)
-        snitt_series = sums_df.mean(axis=1, skipna=True)
+        sums = matrix[active_sum_columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+        # Row statistics over the providers that priced the post; missing sums are skipped like skipna.
+        present = ~np.isnan(sums)
+        counts = present.sum(axis=1)
+        has_sum = counts > 0
+        filled = np.where(present, sums, np.inf)
+        means = np.divide(
+            np.where(present, sums, 0.0).sum(axis=1), counts, out=np.full(len(sums), np.nan), where=has_sum
+        )
+        # The centered sums feed both the sample std and the z-scores.
+        centered = sums - means[:, None]
+        squared = np.square(centered, out=np.zeros_like(sums), where=present)
+        stds = np.sqrt(
+            np.divide(squared.sum(axis=1), counts - 1, out=np.full(len(sums), np.nan), where=counts > 1)
+        )
+        std_ratio = np.divide(stds, means, out=np.zeros_like(stds), where=means != 0)
+        lowest_index = filled.argmin(axis=1)
+        lowest = np.take_along_axis(filled, lowest_index[:, None], axis=1)[:, 0]
+
+        providers = np.asarray([sum_column_provider.get(col, "") for col in active_sum_columns], dtype=object)
+        matrix["vinner"] = np.where(has_sum, providers[lowest_index], "")
+        matrix["lavest_sum"] = np.where(has_sum, lowest, 0.0)
+        matrix["std_avvik"] = np.where(np.isnan(stds), 0.0, stds)
+        snitt_series = pd.Series(means, index=matrix.index)
         matrix["snitt"] = snitt_series.where(~snitt_series.eq(0.0), pd.NA)
-        snitt_divisor = snitt_series.replace({0.0: np.nan})
-        std_ratio = std_series.divide(snitt_divisor)
-        std_ratio = std_ratio.replace([np.inf, -np.inf], np.nan).fillna(0.0)
-        matrix["std_pct"] = (std_ratio * 100.0).astype(float)
+        matrix["std_pct"] = np.nan_to_num(std_ratio, nan=0.0, posinf=0.0, neginf=0.0) * 100.0
 
         # Calculate z-scores for each bid
         num_bids = len(active_sum_columns)
         if num_bids >= 3:
-            for sum_col in active_sum_columns:
-                provider_name = sum_column_provider.get(sum_col, "")
-                z_col = f"{provider_name} (z-score)"
-                z_scores = (sums_df[sum_col] - snitt_series) / std_series
-                z_scores = z_scores.replace([np.inf, -np.inf], np.nan).fillna(0.0)
-                matrix[z_col] = z_scores.astype(float)
+            z_scores = np.divide(centered, stds[:, None], out=np.zeros_like(sums), where=stds[:, None] > 0)
+            z_columns = [f"{sum_column_provider.get(sum_col, '')} (z-score)" for sum_col in active_sum_columns]
+            z_scores = np.nan_to_num(z_scores, nan=0.0, posinf=0.0, neginf=0.0)
+            z_frame = pd.DataFrame(z_scores, index=matrix.index, columns=z_columns)
+            matrix = pd.concat([matrix, z_frame], axis=1)
     else:
         matrix["vinner"] = ""
         matrix["lavest_sum"] = 0.0
@@ -840,7 +1049,7 @@ async def bid_compare(files: list[UploadFile] = File(...)) -> dict[str, Any]:
             matrix[column] = matrix[column].fillna("")
 
     if not matrix.empty:
-        matrix = matrix.sort_values(by="postnr")
+        matrix = matrix.sort_values(by="postnr", ignore_index=True)
 
     if not matrix.empty:
         matrix_sum = {}
@@ -859,7 +1068,9 @@ async def bid_compare(files: list[UploadFile] = File(...)) -> dict[str, Any]:
                 matrix_sum[key] = ""
             else:
                 matrix_sum[key] = ""
-        matrix_disp = pd.concat([matrix, pd.DataFrame([matrix_sum])], ignore_index=True)
+        # Enlarging a shallow copy appends the SUM row without touching the matrix used by the report.
+        matrix_disp = matrix.copy(deep=False)
+        matrix_disp.loc[len(matrix_disp)] = matrix_sum
     else:
         matrix_disp = matrix.copy()
 
@@ -875,38 +1086,19 @@ async def bid_compare(files: list[UploadFile] = File(...)) -> dict[str, Any]:
     chapter_titles = _collect_chapter_titles(bids)
 
     # Chapter summary
-    chapter = pd.DataFrame(columns=["kapittel"])
-    for name, df in base_bids.items():
-        if df.empty:
-            continue
-        part = df.groupby("kapittel", as_index=False)["sum_amount"].sum().rename(columns={"sum_amount": name})
-        if chapter.empty:
-            chapter = part
-        else:
-            chapter = chapter.merge(part, on="kapittel", how="outer")
-    chapter = chapter.fillna(0.0)
+    chapter = _chapter_totals(base_bids)
     if not chapter.empty:
-        chapter["kapittel"] = chapter["kapittel"].astype(str).str.strip()
-        chapter["kapittel_navn"] = chapter["kapittel"].map(lambda code: chapter_titles.get(code, ""))
+        chapter["kapittel_navn"] = chapter["kapittel"].map(chapter_titles).fillna("")
         provider_columns = [col for col in chapter.columns if col not in {"kapittel", "kapittel_navn"}]
-        chapter["laveste_tilbyder"] = ""
-        chapter["laveste_sum"] = 0.0
-        chapter["spann_pct"] = 0.0
-        for idx, row in chapter.iterrows():
-            sums = {col: float(row[col]) for col in provider_columns if col in row}
-            if not sums:
-                continue
-            min_value = min(sums.values())
-            max_value = max(sums.values())
-            if all(abs(v - min_value) < 1e-6 for v in sums.values()):
-                chapter.at[idx, "laveste_tilbyder"] = "N/A"
-                chapter.at[idx, "laveste_sum"] = 0.0
-                chapter.at[idx, "spann_pct"] = 0.0
-            else:
-                min_provider = min(sums, key=sums.get)
-                chapter.at[idx, "laveste_tilbyder"] = min_provider
-                chapter.at[idx, "laveste_sum"] = float(min_value)
-                chapter.at[idx, "spann_pct"] = float(0.0 if min_value == 0 else ((max_value - min_value) / min_value) * 100.0)
+        sums = chapter[provider_columns].to_numpy(dtype=np.float64)
+        min_values = sums.min(axis=1)
+        max_values = sums.max(axis=1)
+        flat = (max_values - min_values) < 1e-6
+        spread = np.divide(max_values - min_values, min_values, out=np.zeros_like(min_values), where=min_values != 0)
+        lowest = np.asarray(provider_columns, dtype=object)[sums.argmin(axis=1)]
+        chapter["laveste_tilbyder"] = np.where(flat, "N/A", lowest)
+        chapter["laveste_sum"] = np.where(flat, 0.0, min_values)
+        chapter["spann_pct"] = np.where(flat, 0.0, spread * 100.0)
 
         ordered_cols = [
             "kapittel",
@@ -928,59 +1120,28 @@ async def bid_compare(files: list[UploadFile] = File(...)) -> dict[str, Any]:
             )
             for key in chapter.columns
         }
-        chapter_disp = pd.concat([chapter, pd.DataFrame([chapter_sum])], ignore_index=True)
+        chapter_disp = chapter.copy(deep=False)
+        chapter_disp.loc[len(chapter_disp)] = chapter_sum
     else:
         chapter_disp = chapter.copy()
 
     # Summary metrics
-    totals = {name: float(df["sum_amount"].sum()) for name, df in base_bids.items()} if base_bids else {}
-    option_totals = {name: float(value) for name, value in option_totals.items()}
+    winner_name = ""
+    winner_total = 0.0
     if totals:
-        min_total = min(totals.values())
-        max_total = max(totals.values())
-        if abs(max_total - min_total) < 1e-6:
-            winner_name = ""
-            winner_total = 0.0
-        else:
-            winner_name = min(totals, key=totals.get)
-            winner_total = totals.get(winner_name, 0.0)
-    else:
-        winner_name = ""
-        winner_total = 0.0
-    if base_bids:
-        post_count = int(
-            len(set(pd.concat([df["postnr"] for df in base_bids.values()], ignore_index=True)))
-        )
-    else:
-        post_count = 0
-
-    # Build Excel output
-    excel_buffer = io.BytesIO()
-    with pd.ExcelWriter(excel_buffer, engine="openpyxl") as writer:
-        for name, df in bids.items():
-            sheet_df = df.copy()
-            option_mask = sheet_df.get("is_option") == True
-            if isinstance(option_mask, pd.Series) and option_mask.any():
-                for col in ["unit_price", "sum_amount"]:
-                    if col in sheet_df.columns:
-                        sheet_df[col] = sheet_df[col].astype(object)
-                        formatted_values = sheet_df.loc[option_mask, col].apply(
-                            lambda x: _format_parenthesized_currency(x) if pd.notna(x) else ""
-                        )
-                        sheet_df.loc[option_mask, col] = formatted_values
-            if "is_option" in sheet_df.columns:
-                sheet_df = sheet_df.drop(columns=["is_option"])
-            sheet_df.to_excel(writer, index=False, sheet_name=name[:28])
-        base_matrix = matrix.copy()
-        if "is_option" in base_matrix.columns:
-            base_matrix = base_matrix.drop(columns=["is_option"])
-        base_matrix.to_excel(writer, index=False, sheet_name="Sammenligning")
-        chapter.to_excel(writer, index=False, sheet_name="Kapittel")
-    excel_bytes = excel_buffer.getvalue()
-    excel_b64 = base64.b64encode(excel_bytes).decode("ascii")
-
-    matrix_excel = _build_matrix_excel(matrix_disp, active_sum_columns, active_unit_columns, column_colors)
-    chapter_excel = _build_chapter_excel(chapter_disp)
+        total_values = np.fromiter(totals.values(), dtype=np.float64, count=len(totals))
+        if np.ptp(total_values) >= 1e-6:
+            lowest = int(total_values.argmin())
+            winner_name = list(totals)[lowest]
+            winner_total = float(total_values[lowest])
+    post_count = len(set().union(*(df["postnr"].unique() for df in base_bids.values())))
+
+    # Build Excel output off the event loop; the three workbooks are independent.
+    excel_b64, matrix_excel, chapter_excel = await asyncio.gather(
+        asyncio.to_thread(_build_report_excel, bids, matrix, chapter),
+        asyncio.to_thread(_build_matrix_excel, matrix_disp, active_sum_columns, active_unit_columns, column_colors),
+        asyncio.to_thread(_build_chapter_excel, chapter_disp),
+    )
 
     result = {
         "normalized": normalized,
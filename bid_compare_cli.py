@@ -9,17 +9,21 @@ Bruk:
 
 import argparse
 import sys
+from collections import Counter
 from pathlib import Path
 
 # Import fra backend
 sys.path.insert(0, str(Path(__file__).parent / "backend"))
 from backend.app.main import (
-    _parse_ns3459_xml,
+    _read_xml_bid,
     _read_tabular,
     _normalize_columns,
-    _extract_company_name,
     _collect_chapter_titles,
-    _aggregate_bid_rows,
+    _build_comparison_matrix,
+    _chapter_totals,
+    _split_options,
+    _unique_name,
+    _unique_truncate,
     _to_float,
 )
 
@@ -34,11 +38,8 @@ def load_bid_file(filepath: Path) -> tuple[str, pd.DataFrame]:
     data = filepath.read_bytes()
 
     if filepath.suffix.lower() == '.xml':
-        df = _parse_ns3459_xml(data, filepath.name)
-        try:
-            name = _extract_company_name(data) or filepath.stem
-        except Exception:
-            name = filepath.stem
+        company, df = _read_xml_bid(data, filepath.name)
+        name = company or filepath.stem
     else:
         df_raw = _read_tabular(filepath.name, data)
         df = _normalize_columns(df_raw)
@@ -47,16 +48,20 @@ def load_bid_file(filepath: Path) -> tuple[str, pd.DataFrame]:
     return name, df
 
 
-def print_summary(bids: dict[str, pd.DataFrame], base_bids: dict[str, pd.DataFrame], option_totals: dict[str, float]):
+def print_summary(
+    bids: dict[str, pd.DataFrame],
+    base_bids: dict[str, pd.DataFrame],
+    totals: dict[str, float],
+    option_totals: dict[str, float],
+):
     """Skriv ut oppsummering til terminal"""
     print("\n" + "=" * 80)
     print("OPPSUMMERING")
     print("=" * 80)
 
-    totals = {name: float(df["sum_amount"].sum()) for name, df in base_bids.items()}
-
     print(f"\nAntall tilbydere: {len(bids)}")
-    print(f"Antall poster: {len(set(pd.concat([df['postnr'] for df in base_bids.values()], ignore_index=True)))}")
+    posts = set().union(*(df["postnr"].unique() for df in base_bids.values()))
+    print(f"Antall poster: {len(posts)}")
 
     print("\nTILBUD (eksklusive opsjoner):")
     print("-" * 80)
@@ -66,8 +71,10 @@ def print_summary(bids: dict[str, pd.DataFrame], base_bids: dict[str, pd.DataFra
         print(f"  {name:40s}  kr {total:15,.2f}{option_str}")
 
     if totals:
-        winner = min(totals, key=totals.get)
-        winner_total = totals[winner]
+        total_values = np.fromiter(totals.values(), dtype=float, count=len(totals))
+        lowest = int(total_values.argmin())
+        winner = list(totals)[lowest]
+        winner_total = float(total_values[lowest])
         print(f"\n{'🏆 VINNER: ' + winner:40s}  kr {winner_total:15,.2f}")
 
     # Z-score summary hvis 3+ tilbud
@@ -75,83 +82,59 @@ def print_summary(bids: dict[str, pd.DataFrame], base_bids: dict[str, pd.DataFra
         print("\nZ-SCORE TOTALER (lavere = bedre):")
         print("-" * 80)
 
-        # Beregn z-score for hver tilbyder
-        z_totals = {}
-        for name in totals.keys():
-            z_totals[name] = 0.0
-
-        # For hver post, beregn z-score
-        all_posts = set()
-        for df in base_bids.values():
-            all_posts.update(df['postnr'].unique())
-
-        for postnr in all_posts:
-            post_sums = []
-            post_names = []
-            for name, df in base_bids.items():
-                row = df[df['postnr'] == postnr]
-                if not row.empty:
-                    post_sums.append(float(row['sum_amount'].iloc[0]))
-                    post_names.append(name)
-
-            if len(post_sums) >= 3:
-                mean = np.mean(post_sums)
-                std = np.std(post_sums, ddof=1)
-                if std > 0:
-                    for i, name in enumerate(post_names):
-                        z = (post_sums[i] - mean) / std
-                        z_totals[name] += z
+        # Første sum per post og tilbyder, én rad per post og én kolonne per tilbyder
+        first_rows = {name: df.drop_duplicates("postnr") for name, df in base_bids.items()}
+        wide = pd.concat(
+            {
+                name: pd.Series(rows["sum_amount"].to_numpy(dtype=float), index=rows["postnr"].astype(str))
+                for name, rows in first_rows.items()
+            },
+            axis=1,
+        )
+        mean = wide.mean(axis=1)
+        std = wide.std(axis=1)
+        scored = (wide.count(axis=1) >= 3) & (std > 0)
+        z_scores = wide[scored].sub(mean[scored], axis=0).div(std[scored], axis=0)
+        z_totals = z_scores.sum().to_dict()
 
         for name, z_total in sorted(z_totals.items(), key=lambda x: x[1]):
             indicator = "✅" if z_total < -1 else "⚠️" if z_total > 1 else "  "
             print(f"  {indicator} {name:38s}  {z_total:8.2f}")
 
 
-def print_chapter_summary(base_bids: dict[str, pd.DataFrame], chapter_titles: dict[str, str]):
+def print_chapter_summary(chapter_df: pd.DataFrame, chapter_titles: dict[str, str]):
     """Skriv ut kapitteloppsummering"""
     print("\n" + "=" * 80)
     print("KAPITTELOPPSUMMERING")
     print("=" * 80)
 
-    chapter_df = pd.DataFrame(columns=["kapittel"])
-    for name, df in base_bids.items():
-        if df.empty:
-            continue
-        part = df.groupby("kapittel", as_index=False)["sum_amount"].sum().rename(columns={"sum_amount": name})
-        if chapter_df.empty:
-            chapter_df = part
-        else:
-            chapter_df = chapter_df.merge(part, on="kapittel", how="outer")
-
-    chapter_df = chapter_df.fillna(0.0)
-    chapter_df = chapter_df.sort_values("kapittel")
-
-    for _, row in chapter_df.iterrows():
-        kapittel = row["kapittel"]
-        kapittel_navn = chapter_titles.get(kapittel, "")
+    provider_cols = [col for col in chapter_df.columns if col != "kapittel"]
+    codes = chapter_df["kapittel"].to_numpy()
+    names = chapter_df["kapittel"].map(chapter_titles).fillna("").to_numpy()
+    sums = chapter_df[provider_cols].to_numpy(dtype=float)
+    # Stabil sortering gir samme rekkefølge som før ved like summer
+    orders = np.argsort(sums, axis=1, kind="stable")
 
+    for kapittel, kapittel_navn, row_sums, order in zip(codes, names, sums, orders):
         print(f"\nKapittel {kapittel}: {kapittel_navn}")
         print("-" * 80)
 
-        provider_cols = [col for col in chapter_df.columns if col not in ["kapittel"]]
-        sums = {col: float(row[col]) for col in provider_cols}
-
-        if sums and max(sums.values()) > 0:
-            winner = min(sums, key=sums.get)
-            for name, amount in sorted(sums.items(), key=lambda x: x[1]):
-                marker = "🏆 " if name == winner else "   "
-                print(f"  {marker}{name:38s}  kr {amount:15,.2f}")
+        if row_sums.size and row_sums.max() > 0:
+            for rank, col in enumerate(order):
+                marker = "🏆 " if rank == 0 else "   "
+                print(f"  {marker}{provider_cols[col]:38s}  kr {row_sums[col]:15,.2f}")
 
 
 def save_excel(output_path: Path, bids: dict[str, pd.DataFrame], matrix: pd.DataFrame, chapter_df: pd.DataFrame):
     """Lagre resultater til Excel"""
     with pd.ExcelWriter(output_path, engine="openpyxl") as writer:
         # Normalized bids
-        for name, df in bids.items():
+        sheet_names = _unique_truncate(bids, reserved=("Sammenligning", "Kapittel"))
+        for sheet_name, df in zip(sheet_names, bids.values()):
             df_copy = df.copy()
             if "is_option" in df_copy.columns:
                 df_copy = df_copy.drop(columns=["is_option"])
-            df_copy.to_excel(writer, index=False, sheet_name=name[:28])
+            df_copy.to_excel(writer, index=False, sheet_name=sheet_name)
 
         # Comparison matrix
         if not matrix.empty:
@@ -181,6 +164,7 @@ def main():
     # Last inn alle filer
     bids = {}
     errors = []
+    name_counts = Counter()
 
     print("Laster tilbud...")
     for filepath in args.files:
@@ -192,12 +176,7 @@ def main():
             name, df = load_bid_file(filepath)
 
             # Håndter duplikatnavn
-            unique_name = name
-            counter = 1
-            while unique_name in bids:
-                counter += 1
-                unique_name = f"{name} ({counter})"
-
+            unique_name = _unique_name(name, name_counts, bids)
             bids[unique_name] = df
             print(f"  ✓ {filepath.name} -> {unique_name}")
         except Exception as e:
@@ -214,42 +193,23 @@ def main():
 
     # Separer base og opsjon
     base_bids = {}
+    totals = {}
     option_totals = {}
     for name, df in bids.items():
-        base_bids[name] = df[df["is_option"] != True].copy()
-        option_totals[name] = float(df[df["is_option"] == True]["sum_amount"].sum())
+        base_bids[name], totals[name], option_totals[name] = _split_options(df)
 
     # Bygg comparison matrix
-    matrix = pd.DataFrame(columns=["postnr"])
-    sum_columns = []
-
-    for idx, (name, df) in enumerate(base_bids.items()):
-        unit_col = f"{name} (enhetspris)"
-        sum_col = f"{name} (sum)"
-        part = _aggregate_bid_rows(df, unit_col, sum_col)
-        if idx == 0:
-            matrix = part
-        else:
-            matrix = matrix.merge(part, on="postnr", how="outer")
-        sum_columns.append(sum_col)
+    matrix = _build_comparison_matrix(base_bids)
 
     # Kapitteloppsummering
     chapter_titles = _collect_chapter_titles(bids)
-    chapter_df = pd.DataFrame(columns=["kapittel"])
-    for name, df in base_bids.items():
-        if df.empty:
-            continue
-        part = df.groupby("kapittel", as_index=False)["sum_amount"].sum().rename(columns={"sum_amount": name})
-        if chapter_df.empty:
-            chapter_df = part
-        else:
-            chapter_df = chapter_df.merge(part, on="kapittel", how="outer")
+    chapter_df = _chapter_totals(base_bids)
 
     # Vis resultater
-    print_summary(bids, base_bids, option_totals)
+    print_summary(bids, base_bids, totals, option_totals)
 
     if args.verbose and not chapter_df.empty:
-        print_chapter_summary(base_bids, chapter_titles)
+        print_chapter_summary(chapter_df, chapter_titles)
 
     # Lagre Excel (alltid)
     save_excel(args.output, bids, matrix, chapter_df)